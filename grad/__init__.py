@@ -1,12 +1,4 @@
 from . import variable as vp
 from .variable import Variable as vn
-
-class no_grad:
-    def __init__(self):
-        pass
-
-    def __enter__(self):
-        vp.is_grad_enabled = False
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        vp.is_grad_enabled = True
\ No newline at end of file
+from .variable import checkpoint, no_grad
+from .dual import forward_grad
@@ -0,0 +1,57 @@
+import math
+import os
+import numpy as np
+
+
+# backward kernels of the transcendental gates. python scalars go through
+# math, which skips the numpy ufunc dispatch; arrays go through numpy.
+# numba is opt-in with GRADINO_NUMBA=1, since importing it costs far more
+# than it saves on these one-line array expressions.
+
+def _array_kernel(fn):
+    if os.environ.get('GRADINO_NUMBA') != '1':
+        return fn
+    try:
+        from numba import njit
+    except ImportError:
+        return fn
+    return njit(cache=True)(fn)
+
+
+@_array_kernel
+def _mul_cos(grad, x):
+    return grad * np.cos(x)
+
+
+@_array_kernel
+def _mul_neg_sin(grad, x):
+    return -grad * np.sin(x)
+
+
+@_array_kernel
+def _mul_log(grad, x):
+    return grad * np.log(x)
+
+
+def mul_cos(grad, x):
+    if type(x) is float or type(x) is int:
+        try:
+            return grad * math.cos(x)
+        except (ValueError, OverflowError):
+            pass
+    return _mul_cos(grad, x)
+
+
+def mul_neg_sin(grad, x):
+    if type(x) is float or type(x) is int:
+        try:
+            return -grad * math.sin(x)
+        except (ValueError, OverflowError):
+            pass
+    return _mul_neg_sin(grad, x)
+
+
+def mul_log(grad, x):
+    if (type(x) is float or type(x) is int) and x > 0:
+        return grad * math.log(x)
+    return _mul_log(grad, x)
@@ -1,11 +1,15 @@
+import math
 import numpy as np
-import graphviz
+from . import _kernels as k
+from . import variable as vp
 
 
 class Gate:
-    def __init__(self, name):
-        self.name = name
-        self.vars = []
+    __slots__ = ('vars',)
+    name = None
+
+    def __init__(self, *vars):
+        self.vars = vars
 
     def __repr__(self):
         return f"Gate({self.name})"
@@ -13,350 +17,444 @@ class Gate:
     def forward(self):
         raise NotImplementedError
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         raise NotImplementedError
 
-    def __call__(self, *args, **kwds):
-        return self.forward(*args, **kwds)
-
-    def draw_graph(self, graph):
-        for var in self.vars:
-            if not var.is_graph:
-                if var.gate is not None and var.gate.name == 'identity' and var.requires_grad:
-                    graph.node(
-                        str(id(var)), f'{var.data:.4g}', style='filled', fillcolor='lightblue')
-                else:
-                    graph.node(str(id(var)), f'{var.data:.4g}')
-                var.is_graph = True
-            label = None
-            if var.requires_grad:
-                label = f'{var.grad:.4g}'
-            graph.edge(str(id(var)), str(id(self)), label=label)
-            var.draw_graph(graph)
-    
-    def clear_graph(self):
-        for var in self.vars:
-            var.clear_graph()
-
-    def zero_grad(self):
-        for var in self.vars:
-            var.zero_grad()
-
-
-class Identity(Gate):
-    def __init__(self):
-        super().__init__("identity")
-
-    def forward(self, x):
-        return x
-
-    def backward(self, grad, make_graph=False):
-        return grad
-
 
 class Add(Gate):
-    def __init__(self):
-        super().__init__("add")
+    __slots__ = ()
+    name = "add"
 
-    def forward(self, x, y):
-        self.vars = [x, y]
+    def forward(self):
+        x, y = self.vars
         return x.data + y.data
 
-    def backward(self, grad, make_graph=False):
-        self.vars[0].backward(grad, make_graph=make_graph)
-        self.vars[1].backward(grad, make_graph=make_graph)
+    def vjp(self, grad, make_graph=False):
+        return (grad, grad)
+
+
+class Sub(Gate):
+    __slots__ = ()
+    name = "sub"
+
+    def forward(self):
+        x, y = self.vars
+        return x.data - y.data
+
+    def vjp(self, grad, make_graph=False):
+        return (grad, -grad)
 
 
 class Mul(Gate):
-    def __init__(self):
-        super().__init__("mul")
+    __slots__ = ()
+    name = "mul"
 
-    def forward(self, x, y):
-        self.vars = [x, y]
+    def forward(self):
+        x, y = self.vars
         return x.data * y.data
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0, var1 = self.vars[0], self.vars[1]
         if not make_graph:
             var0, var1 = var0.data, var1.data
-        self.vars[0].backward(grad * var1, make_graph=make_graph)
-        self.vars[1].backward(grad * var0, make_graph=make_graph)
+        return (grad * var1, grad * var0)
+
+
+class ScaleBy(Gate):
+    __slots__ = ('scale',)
+    name = "scale"
+
+    def __init__(self, x, scale):
+        super().__init__(x)
+        self.scale = scale
+
+    def forward(self):
+        x = self.vars[0]
+        return x.data * self.scale
+
+    def vjp(self, grad, make_graph=False):
+        return (grad * self.scale,)
+
+
+class SumTo(Gate):
+    __slots__ = ('shape',)
+    name = "sum"
+
+    def __init__(self, x, shape):
+        super().__init__(x)
+        self.shape = shape
+
+    def forward(self):
+        x = self.vars[0]
+        return sum_to(x.data, self.shape)
+
+    def vjp(self, grad, make_graph=False):
+        return (grad * np.ones(np.shape(self.vars[0].data)),)
 
 
 class Neg(Gate):
-    def __init__(self):
-        super().__init__("neg")
+    __slots__ = ()
+    name = "neg"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return -x.data
 
-    def backward(self, grad, make_graph=False):
-        self.vars[0].backward(-grad, make_graph=make_graph)
+    def vjp(self, grad, make_graph=False):
+        return (-grad,)
 
 
 class Abs(Gate):
-    def __init__(self):
-        super().__init__("abs")
+    __slots__ = ()
+    name = "abs"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return abs(x.data)
 
-    def backward(self, grad, make_graph=False):
-        self.vars[0].backward(
-            grad * (-1 if self.vars[0].data < 0 else 1), make_graph=make_graph)
+    def vjp(self, grad, make_graph=False):
+        x = self.vars[0].data
+        if isinstance(x, np.ndarray):
+            return (grad * np.copysign(1.0, x),)
+        return (grad * math.copysign(1.0, x),)
 
 
 class Div(Gate):
-    def __init__(self):
-        super().__init__("div")
+    __slots__ = ()
+    name = "div"
 
-    def forward(self, x, y):
-        self.vars = [x, y]
+    def forward(self):
+        x, y = self.vars
         return x.data / y.data
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0, var1 = self.vars[0], self.vars[1]
         if not make_graph:
             var0, var1 = var0.data, var1.data
+        grads = [None, None]
         if self.vars[0].requires_grad:
-            self.vars[0].backward(grad / var1, make_graph=make_graph)
+            grads[0] = grad / var1
         if self.vars[1].requires_grad:
-            self.vars[1].backward(-grad * var0 / var1 **
-                                  2, make_graph=make_graph)
+            grads[1] = -grad * var0 / var1 ** 2
+        return grads
 
 
 class Pow(Gate):
-    def __init__(self):
-        super().__init__("pow")
+    __slots__ = ('out', 'fast_exponent')
+    name = "pow"
 
-    def forward(self, x, y):
-        self.vars = [x, y]
-        return x.data ** y.data
+    def forward(self):
+        x, y = self.vars
+        self.out = x.data ** y.data
+        self.fast_exponent = _fast_exponent(y.data)
+        return self.out
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0, var1 = self.vars[0], self.vars[1]
         if not make_graph:
             var0, var1 = var0.data, var1.data
+        grads = [None, None]
         if self.vars[0].requires_grad:
-            self.vars[0].backward(grad * var1 * var0 **
-                                  (var1 - 1), make_graph=make_graph)
+            if make_graph or self.fast_exponent is None:
+                grads[0] = grad * var1 * var0 ** (var1 - 1)
+            else:
+                grads[0] = self._fast_base_grad(grad, var0)
         if self.vars[1].requires_grad:
-            self.vars[1].backward(grad * var0 ** var1 *
-                                  np.log(var0), make_graph=make_graph)
+            if make_graph:
+                grads[1] = grad * var0 ** var1 * np.log(var0)
+            else:
+                grads[1] = k.mul_log(grad * self.out, var0)
+        return grads
+
+    def _fast_base_grad(self, grad, x):
+        n = self.fast_exponent
+        if n == 0.5:
+            return grad / (2 * self.out)
+        if n in (0, 1):
+            return grad * float(n)
+        if n == 2:
+            return 2.0 * grad * x
+        return grad * n * x ** (n - 1)
+
+
+def sum_to(x, shape):
+    # sum a broadcast array back down to shape
+    if np.shape(x) == shape:
+        return x
+    x = np.sum(x, axis=tuple(range(np.ndim(x) - len(shape))))
+    axes = tuple(i for i, n in enumerate(shape) if n == 1 and x.shape[i] != 1)
+    if axes:
+        x = np.sum(x, axis=axes, keepdims=True)
+    return x
+
+
+def _fast_exponent(y):
+    # exponents whose base derivative is cheaper than a generic float power
+    if isinstance(y, np.ndarray):
+        return None
+    if y == 0.5:
+        return 0.5
+    if float(y).is_integer() and -2 <= y <= 8:
+        return int(y)
+    return None
+
+
+class Sqrt(Gate):
+    __slots__ = ('out',)
+    name = "sqrt"
+
+    def forward(self):
+        x = self.vars[0]
+        self.out = np.sqrt(x.data)
+        return self.out
+
+    def vjp(self, grad, make_graph=False):
+        var0 = self.vars[0]
+        if make_graph:
+            return (grad / (2 * np.sqrt(var0)),)
+        return (grad / (2 * self.out),)
 
 
 class Sin(Gate):
-    def __init__(self):
-        super().__init__("sin")
+    __slots__ = ()
+    name = "sin"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.sin(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
-        if not make_graph:
-            var0 = var0.data
-        self.vars[0].backward(grad * np.cos(var0), make_graph=make_graph)
+        if make_graph:
+            return (grad * np.cos(var0),)
+        return (k.mul_cos(grad, var0.data),)
 
 
 class Asin(Gate):
-    def __init__(self):
-        super().__init__("asin")
+    __slots__ = ()
+    name = "asin"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arcsin(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(
-            grad / np.sqrt(1 - var0 ** 2), make_graph=make_graph)
+        return (grad / np.sqrt(1 - var0 ** 2),)
 
 
 class Sinh(Gate):
-    def __init__(self):
-        super().__init__("sinh")
+    __slots__ = ()
+    name = "sinh"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.sinh(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad * np.cosh(var0), make_graph=make_graph)
+        return (grad * np.cosh(var0),)
 
 
 class Asinh(Gate):
-    def __init__(self):
-        super().__init__("asinh")
+    __slots__ = ()
+    name = "asinh"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arcsinh(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(
-            grad / np.sqrt(1 + var0 ** 2), make_graph=make_graph)
+        return (grad / np.sqrt(1 + var0 ** 2),)
 
 
 class Cos(Gate):
-    def __init__(self):
-        super().__init__("cos")
+    __slots__ = ()
+    name = "cos"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.cos(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
-        if not make_graph:
-            var0 = var0.data
-        self.vars[0].backward(-grad * np.sin(var0), make_graph=make_graph)
+        if make_graph:
+            return (-grad * np.sin(var0),)
+        return (k.mul_neg_sin(grad, var0.data),)
 
 
 class Acos(Gate):
-    def __init__(self):
-        super().__init__("acos")
+    __slots__ = ()
+    name = "acos"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arccos(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(-grad / np.sqrt(1 - var0 **
-                              2), make_graph=make_graph)
+        return (-grad / np.sqrt(1 - var0 ** 2),)
 
 
 class Cosh(Gate):
-    def __init__(self):
-        super().__init__("cosh")
+    __slots__ = ()
+    name = "cosh"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.cosh(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad * np.sinh(var0), make_graph=make_graph)
+        return (grad * np.sinh(var0),)
 
 
 class Acosh(Gate):
-    def __init__(self):
-        super().__init__("acosh")
+    __slots__ = ()
+    name = "acosh"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arccosh(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(
-            grad / np.sqrt(var0 ** 2 - 1), make_graph=make_graph)
+        return (grad / np.sqrt(var0 ** 2 - 1),)
 
 
 class Tan(Gate):
-    def __init__(self):
-        super().__init__("tan")
+    __slots__ = ()
+    name = "tan"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.tan(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad / np.cos(var0) ** 2, make_graph=make_graph)
+        return (grad / np.cos(var0) ** 2,)
 
 
 class Atan(Gate):
-    def __init__(self):
-        super().__init__("atan")
+    __slots__ = ()
+    name = "atan"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arctan(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad / (1 + var0 ** 2), make_graph=make_graph)
+        return (grad / (1 + var0 ** 2),)
 
 
 class Tanh(Gate):
-    def __init__(self):
-        super().__init__("tanh")
+    __slots__ = ('out',)
+    name = "tanh"
 
-    def forward(self, x):
-        self.vars = [x]
-        return np.tanh(x.data)
+    def forward(self):
+        x = self.vars[0]
+        self.out = np.tanh(x.data)
+        return self.out
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
-        if not make_graph:
-            var0 = var0.data
-        self.vars[0].backward(
-            grad * (1 - np.tanh(var0) ** 2), make_graph=make_graph)
+        if make_graph:
+            return (grad * (1 - np.tanh(var0) ** 2),)
+        return (grad * (1 - self.out * self.out),)
 
 
 class Atanh(Gate):
-    def __init__(self):
-        super().__init__("atanh")
+    __slots__ = ()
+    name = "atanh"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.arctanh(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad / (1 - var0 ** 2), make_graph=make_graph)
+        return (grad / (1 - var0 ** 2),)
 
 
 class Exp(Gate):
-    def __init__(self):
-        super().__init__("exp")
+    __slots__ = ('out',)
+    name = "exp"
 
-    def forward(self, x):
-        self.vars = [x]
-        return np.exp(x.data)
+    def forward(self):
+        x = self.vars[0]
+        self.out = np.exp(x.data)
+        return self.out
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
-        if not make_graph:
-            var0 = var0.data
-        self.vars[0].backward(grad * np.exp(var0), make_graph=make_graph)
+        if make_graph:
+            return (grad * np.exp(var0),)
+        return (grad * self.out,)
 
 
 class Log(Gate):
-    def __init__(self):
-        super().__init__("log")
+    __slots__ = ()
+    name = "log"
 
-    def forward(self, x):
-        self.vars = [x]
+    def forward(self):
+        x = self.vars[0]
         return np.log(x.data)
 
-    def backward(self, grad, make_graph=False):
+    def vjp(self, grad, make_graph=False):
         var0 = self.vars[0]
         if not make_graph:
             var0 = var0.data
-        self.vars[0].backward(grad / var0, make_graph=make_graph)
+        return (grad / var0,)
+
+
+class Checkpoint(Gate):
+    __slots__ = ('fn',)
+    name = "checkpoint"
+
+    def __init__(self, fn, *vars):
+        super().__init__(*vars)
+        self.fn = fn
+
+    def forward(self):
+        # run fn without recording a graph, so none of its intermediates are kept
+        with vp.no_grad():
+            return self._call(self.vars).data
+
+    def vjp(self, grad, make_graph=False):
+        # rebuild the graph of fn and backpropagate through it
+        inputs = [vp.Variable(x.data, requires_grad=x.requires_grad) for x in self.vars]
+        self._call(inputs).backward(grad, make_graph=make_graph)
+        if make_graph:
+            # hang the rebuilt leaves off the real inputs, so the gradient graph
+            # just built reaches self.vars for higher-order derivatives
+            for x, y in zip(self.vars, inputs):
+                if y.requires_grad:
+                    y.gate = ScaleBy(x, 1)
+        return [y.grad for y in inputs]
+
+    def _call(self, inputs):
+        out = self.fn(*inputs)
+        if isinstance(out, vp.Variable):
+            return out
+        # a plain number does not depend on the inputs
+        return vp.Variable(out, requires_grad=False)
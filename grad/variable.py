@@ -1,28 +1,52 @@
+import threading
 import numpy as np
 from . import gate as g
-import graphviz
 
-is_grad_enabled = True
+class _GradState(threading.local):
+    # class-level default, so a lookup in a fresh thread does not miss
+    enabled = True
+
+
+# no_grad state is per thread so one thread's no_grad does not leak into others
+_tls = _GradState()
+
+
+def _grad_enabled():
+    return _tls.enabled
+
+
+class no_grad:
+    def __init__(self):
+        self.prev = True
+
+    def __enter__(self):
+        self.prev = _grad_enabled()
+        _tls.enabled = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _tls.enabled = self.prev
 
 
 class Variable:
+    __slots__ = ('data', 'grad', 'gate', 'requires_grad', 'is_graph')
+
     def __init__(self, data, gate=None, requires_grad=True):
-        if isinstance(data, Variable):
-            self = data
-            return
+        t = type(data)
+        if t is float or t is int:
+            pass
         elif isinstance(data, (int, np.uint8, np.uint16, np.uint32, np.uint64, np.int8, np.int16, np.int32, np.int64)):
             data = int(data)
         elif isinstance(data, (float, np.float16, np.float32, np.float64)):
             data = float(data)
+        elif isinstance(data, np.ndarray) and data.dtype.kind in 'biuf':
+            if data.dtype.kind != 'f':
+                data = data.astype(np.float64)
         else:
-            raise TypeError('expected int or float, got ' +
+            raise TypeError('expected int, float or numeric ndarray, got ' +
                             str(type(data)) + " instead")
         self.data = data
-        self.grad = 0
-        if gate is None or not is_grad_enabled:
-            self.gate = g.Identity()
-        else:
-            self.gate = gate
+        self.grad = _zeros_like(data)
+        self.gate = gate if _grad_enabled() else None
         self.requires_grad = requires_grad
         self.is_graph = False
 
@@ -42,44 +66,120 @@ class Variable:
         return self.data.__format__(*args, **kwargs)
 
     def backward(self, grad=None, make_graph=False):
-        if not self.requires_grad or not is_grad_enabled:
+        if not self.requires_grad or not _grad_enabled():
             return
         if grad is None:
+            grad = np.ones_like(self.data) if isinstance(self.data, np.ndarray) else 1
             if make_graph:
-                grad = Variable(1, requires_grad=False)
-            else:
-                grad = 1
-        self.grad += grad
-        self.gate.backward(grad=grad, make_graph=make_graph)
-    
+                grad = Variable(grad, requires_grad=False)
+        elif isinstance(self.data, np.ndarray) and not isinstance(grad, Variable):
+            grad = np.broadcast_to(grad, self.data.shape)
+        # a variable is ready once every consumer on the graph has passed its
+        # grad down, so each gate runs once, in topological order. leaves have
+        # nothing to wait for and take their grads as they arrive. the graph is
+        # walked with explicit stacks so depth is not bound by recursion
+        pending = self._consumers()
+        grads = {}
+        ready = [(self, grad)]
+        while ready:
+            var, grad = ready.pop()
+            _accumulate(var, grad)
+            gate = var.gate
+            if gate is None:
+                continue
+            for parent, contrib in zip(gate.vars, gate.vjp(grad, make_graph=make_graph)):
+                if not parent.requires_grad:
+                    continue
+                if isinstance(contrib, (np.ndarray, Variable)):
+                    contrib = _unbroadcast(contrib, np.shape(parent.data))
+                # each gate belongs to one variable, so it keys that variable
+                key = parent.gate
+                if key is None:
+                    _accumulate(parent, contrib)
+                    continue
+                left = pending[key] - 1
+                if left:
+                    # more consumers to come, so hold the partial sum
+                    pending[key] = left
+                    if key in grads:
+                        contrib = grads[key] + contrib
+                    grads[key] = contrib
+                    continue
+                if key in grads:
+                    contrib = grads.pop(key) + contrib
+                ready.append((parent, contrib))
+
+    def _consumers(self):
+        # number of gate inputs on the graph that each non-leaf variable
+        # feeds, keyed by its gate and counting only variables that need grad
+        pending = {}
+        if self.gate is None:
+            return pending
+        stack = [self.gate]
+        while stack:
+            for parent in stack.pop().vars:
+                gate = parent.gate
+                if gate is None or not parent.requires_grad:
+                    continue
+                if gate in pending:
+                    pending[gate] += 1
+                else:
+                    pending[gate] = 1
+                    stack.append(gate)
+        return pending
+
     def draw_graph(self, graph=None):
         if graph is None:
+            # graphviz is only needed for drawing, so keep it off the import path
+            import graphviz
             graph = graphviz.Digraph()
-        if not self.is_graph:
-            if self.gate is not None and self.gate.name == 'identity' and self.requires_grad:
-                graph.node(str(id(self)), f'{self.data:.4g}', style='filled', fillcolor='lightblue')
-            else:
-                graph.node(str(id(self)), f'{self.data:.4g}')
-            self.is_graph = True
-        if self.gate is not None and self.gate.name != 'identity':
-            graph.node(str(id(self.gate)), self.gate.name, style='filled', fillcolor='lightgreen')
-            label = None
-            if self.requires_grad:
-                label = f'{self.grad:.4g}'
-            graph.edge(str(id(self.gate)), str(id(self)), label=label)
-            self.gate.draw_graph(graph)
+        stack, seen = [self], set()
+        while stack:
+            var = stack.pop()
+            if id(var) in seen:
+                continue
+            seen.add(id(var))
+            if not var.is_graph:
+                if var.gate is None and var.requires_grad:
+                    graph.node(str(id(var)), _format(var.data), style='filled', fillcolor='lightblue')
+                else:
+                    graph.node(str(id(var)), _format(var.data))
+                var.is_graph = True
+            if var.gate is None:
+                continue
+            graph.node(str(id(var.gate)), var.gate.name, style='filled', fillcolor='lightgreen')
+            graph.edge(str(id(var.gate)), str(id(var)), label=_grad_label(var))
+            for parent in var.gate.vars:
+                graph.edge(str(id(parent)), str(id(var.gate)), label=_grad_label(parent))
+                stack.append(parent)
         return graph
-    
-    def clear_graph(self):
-        self.is_graph = False
-        self.gate.clear_graph()
 
+    def clear_graph(self):
+        stack, seen = [self], set()
+        while stack:
+            var = stack.pop()
+            if id(var) in seen:
+                continue
+            seen.add(id(var))
+            var.is_graph = False
+            if var.gate is not None:
+                stack.extend(var.gate.vars)
 
     def zero_grad(self):
-        if not self.requires_grad or not is_grad_enabled:
+        if not self.requires_grad or not _grad_enabled():
+            return
+        if self.gate is None:
+            self.grad = _zeros_like(self.data)
             return
-        self.grad = 0
-        self.gate.zero_grad()
+        stack, seen = [self], set()
+        while stack:
+            var = stack.pop()
+            if id(var) in seen:
+                continue
+            seen.add(id(var))
+            var.grad = _zeros_like(var.data)
+            if var.gate is not None:
+                stack.extend(p for p in var.gate.vars if p.requires_grad)
 
     def __eq__(self, other):
         if not isinstance(other, Variable):
@@ -115,18 +215,20 @@ class Variable:
         return self
 
     def __neg__(self):
-        gate = g.Neg()
-        return Variable(gate(self), gate=gate)
+        gate = g.Neg(self)
+        return Variable(gate.forward(), gate=gate)
 
     def __abs__(self):
-        gate = g.Abs()
-        return Variable(gate(self), gate=gate)
+        gate = g.Abs(self)
+        return Variable(gate.forward(), gate=gate)
 
     def __add__(self, other):
         if not isinstance(other, Variable):
             other = Variable(other, requires_grad=False)
-        gate = g.Add()
-        return Variable(gate(self, other), gate=gate)
+        if not (_grad_enabled() and (self.requires_grad or other.requires_grad)):
+            return _constant(self.data + other.data)
+        gate = g.Add(self, other)
+        return Variable(gate.forward(), gate=gate)
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -134,10 +236,10 @@ class Variable:
     def __sub__(self, other):
         if not isinstance(other, Variable):
             other = Variable(other, requires_grad=False)
-        gate = g.Neg()
-        other = Variable(gate(other), gate=gate)
-        gate = g.Add()
-        return Variable(gate(self, other), gate=gate)
+        if not (_grad_enabled() and (self.requires_grad or other.requires_grad)):
+            return _constant(self.data - other.data)
+        gate = g.Sub(self, other)
+        return Variable(gate.forward(), gate=gate)
 
     def __rsub__(self, other):
         if not isinstance(other, Variable):
@@ -147,8 +249,15 @@ class Variable:
     def __mul__(self, other):
         if not isinstance(other, Variable):
             other = Variable(other, requires_grad=False)
-        gate = g.Mul()
-        return Variable(gate(self, other), gate=gate)
+        if not (_grad_enabled() and (self.requires_grad or other.requires_grad)):
+            return _constant(self.data * other.data)
+        if not self.requires_grad:
+            gate = g.ScaleBy(other, self.data)
+        elif not other.requires_grad:
+            gate = g.ScaleBy(self, other.data)
+        else:
+            gate = g.Mul(self, other)
+        return Variable(gate.forward(), gate=gate)
 
     def __rmul__(self, other):
         return self.__mul__(other)
@@ -156,8 +265,10 @@ class Variable:
     def __truediv__(self, other):
         if not isinstance(other, Variable):
             other = Variable(other, requires_grad=False)
-        gate = g.Div()
-        return Variable(gate(self, other), gate=gate)
+        if not (_grad_enabled() and (self.requires_grad or other.requires_grad)):
+            return _constant(self.data / other.data)
+        gate = g.Div(self, other)
+        return Variable(gate.forward(), gate=gate)
 
     def __rtruediv__(self, other):
         if not isinstance(other, Variable):
@@ -167,8 +278,10 @@ class Variable:
     def __pow__(self, other):
         if not isinstance(other, Variable):
             other = Variable(other, requires_grad=False)
-        gate = g.Pow()
-        return Variable(gate(self, other), gate=gate)
+        if not (_grad_enabled() and (self.requires_grad or other.requires_grad)):
+            return _constant(self.data ** other.data)
+        gate = g.Pow(self, other)
+        return Variable(gate.forward(), gate=gate)
 
     def __rpow__(self, other):
         if not isinstance(other, Variable):
@@ -176,68 +289,111 @@ class Variable:
         return other ** self
 
     def sqrt(self):
-        return self ** 0.5
+        gate = g.Sqrt(self)
+        return Variable(gate.forward(), gate=gate)
 
     def sin(self):
-        gate = g.Sin()
-        return Variable(gate(self), gate=gate)
+        gate = g.Sin(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arcsin(self):
-        gate = g.Asin()
-        return Variable(gate(self), gate=gate)
+        gate = g.Asin(self)
+        return Variable(gate.forward(), gate=gate)
 
     def sinh(self):
-        gate = g.Sinh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Sinh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arcsinh(self):
-        gate = g.Asinh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Asinh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def cos(self):
-        gate = g.Cos()
-        return Variable(gate(self), gate=gate)
+        gate = g.Cos(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arccos(self):
-        gate = g.Acos()
-        return Variable(gate(self), gate=gate)
+        gate = g.Acos(self)
+        return Variable(gate.forward(), gate=gate)
 
     def cosh(self):
-        gate = g.Cosh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Cosh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arccosh(self):
-        gate = g.Acosh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Acosh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def tan(self):
-        gate = g.Tan()
-        return Variable(gate(self), gate=gate)
+        gate = g.Tan(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arctan(self):
-        gate = g.Atan()
-        return Variable(gate(self), gate=gate)
+        gate = g.Atan(self)
+        return Variable(gate.forward(), gate=gate)
 
     def tanh(self):
-        gate = g.Tanh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Tanh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def arctanh(self):
-        gate = g.Atanh()
-        return Variable(gate(self), gate=gate)
+        gate = g.Atanh(self)
+        return Variable(gate.forward(), gate=gate)
 
     def exp(self):
-        gate = g.Exp()
-        return Variable(gate(self), gate=gate)
+        gate = g.Exp(self)
+        return Variable(gate.forward(), gate=gate)
 
     def log(self):
-        gate = g.Log()
-        return Variable(gate(self), gate=gate)
+        gate = g.Log(self)
+        return Variable(gate.forward(), gate=gate)
 
     def conjugate(self):
         return self
 
 
+def _constant(data):
+    # results computed under no_grad stay trainable, folded constants do not
+    return Variable(data, requires_grad=not _grad_enabled())
+
+
+def _format(value):
+    if isinstance(value, Variable):
+        value = value.data
+    if isinstance(value, np.ndarray):
+        return f'array{value.shape}'
+    return f'{value:.4g}'
+
+
+def _grad_label(var):
+    if var.requires_grad:
+        return _format(var.grad)
+    return None
+
+
+def _zeros_like(data):
+    if isinstance(data, np.ndarray):
+        return np.zeros_like(data)
+    return 0
+
+
+def _accumulate(var, grad):
+    if isinstance(grad, Variable):
+        var.grad = grad + var.grad
+    else:
+        var.grad += grad
+
+
+def _unbroadcast(grad, shape):
+    # sum a broadcast gradient back down to the shape of the variable it belongs to
+    if isinstance(grad, Variable):
+        if np.shape(grad.data) == shape:
+            return grad
+        gate = g.SumTo(grad, shape)
+        return Variable(gate.forward(), gate=gate)
+    return g.sum_to(grad, shape)
+
+
 def array(data, requires_grad=True):
     if isinstance(data, Variable):
         return data
@@ -248,13 +404,23 @@ def array(data, requires_grad=True):
     return Variable(data, requires_grad=requires_grad)
 
 
+def checkpoint(fn, *inputs):
+    inputs = [x if isinstance(x, Variable) else Variable(x, requires_grad=False) for x in inputs]
+    gate = g.Checkpoint(fn, *inputs)
+    return Variable(gate.forward(), gate=gate)
+
+
 def array_grad(data):
     if isinstance(data, Variable):
         return data.grad
     if isinstance(data, (list, tuple)):
         return [array_grad(x) for x in data]
     if isinstance(data, np.ndarray):
-        return np.array([array_grad(x) for x in data])
+        grads = _array_grad(data)
+        # after make_graph, any element may hold a Variable grad
+        if Variable in set(map(type, grads.flat)):
+            return grads
+        return grads.astype(np.float64, copy=False)
     return data
 
 
@@ -265,5 +431,18 @@ def array_zero_grad(data):
         for x in data:
             array_zero_grad(x)
     elif isinstance(data, np.ndarray):
-        for x in data:
-            array_zero_grad(x)
+        _array_zero_grad(data)
+
+
+def _grad_of(x):
+    return x.grad if isinstance(x, Variable) else x
+
+
+def _zero_grad_of(x):
+    if isinstance(x, Variable):
+        x.zero_grad()
+
+
+# elementwise helpers that walk object arrays in C instead of a python loop
+_array_grad = np.frompyfunc(_grad_of, 1, 1)
+_array_zero_grad = np.frompyfunc(_zero_grad_of, 1, 1)